@@ -4,32 +4,84 @@
 
 """Driver for collecting data from Rainwise IP-100"""
 
+import collections
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import io
+import math
+import os
+import re
+import select
 import syslog
+import threading
 import time
 import urllib2
 import socket
-from xml.etree import ElementTree
+import sys
+
+try:
+    from lxml import etree as ElementTree
+    PARSE_ERRORS = (ElementTree.XMLSyntaxError,)
+except ImportError:
+    try:
+        from xml.etree import cElementTree as ElementTree
+    except ImportError:
+        from xml.etree import ElementTree
+    PARSE_ERRORS = (ElementTree.ParseError,)
+
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+except ImportError:
+    requests = None
 
 import weewx
 import weewx.drivers
 
 DRIVER_NAME = 'IP100'
-DRIVER_VERSION = '0.4'
-
-def logmsg(dst, msg):
+DRIVER_VERSION = '0.5'
+
+# weather elements in the status that are known to report their value in a
+# 'current' child.  other elements are searched for a 'current' child.
+_CURRENT_TAGS = frozenset(['temperature_outside', 'temperature_inside',
+                           'humidity', 'pressure', 'precipitation',
+                           'solar_radiation'])
+
+# patterns for picking values out of the status without building a tree.
+# these depend on the layout that the IP-100 uses for its status.
+_RX_ROOT = re.compile(r'<(\w+)')
+# entities, self-closing tags and attributes, which the patterns do not handle
+_RX_UNHANDLED = re.compile(r'&|/>|<\w+\s')
+_RX_HARDWARE = re.compile(r'<hardware>(.*?)</hardware>', re.S)
+_RX_WEATHER = re.compile(r'<weather>(.*?)</weather>', re.S)
+_RX_WIND = re.compile(r'<wind>(.*?)</wind>', re.S)
+_RX_LEAF = re.compile(r'<(\w+)>([^<]*)</\1>')
+_RX_CURRENT = re.compile(
+    r'<(\w+)>(?:(?!</\1>).)*?<current>([^<]*)</current>', re.S)
+
+def logmsg(dst, msg, *args):
+    if args:
+        msg = msg % args
     syslog.syslog(dst, 'ip100: %s' % msg)
 
-def logdbg(msg):
-    logmsg(syslog.LOG_DEBUG, msg)
+def debug_enabled():
+    return syslog.setlogmask(0) & syslog.LOG_MASK(syslog.LOG_DEBUG)
+
+def logdbg(msg, *args):
+    # skip the formatting when syslog would discard the message anyway
+    if debug_enabled():
+        logmsg(syslog.LOG_DEBUG, msg, *args)
 
-def loginf(msg):
-    logmsg(syslog.LOG_INFO, msg)
+def loginf(msg, *args):
+    logmsg(syslog.LOG_INFO, msg, *args)
 
-def logcrt(msg):
-    logmsg(syslog.LOG_CRIT, msg)
+def logcrt(msg, *args):
+    logmsg(syslog.LOG_CRIT, msg, *args)
 
-def logerr(msg):
-    logmsg(syslog.LOG_ERR, msg)
+def logerr(msg, *args):
+    logmsg(syslog.LOG_ERR, msg, *args)
 
 
 def loader(config_dict, engine):
@@ -99,106 +151,397 @@ class IP100Driver(weewx.drivers.AbstractDevice):
         'radiation': 'solar_radiation'}
 
     def __init__(self, **stn_dict):
-        loginf('driver version is %s' % DRIVER_VERSION)
+        loginf('driver version is %s', DRIVER_VERSION)
         if 'station_url' in stn_dict:
             self.station_url = stn_dict['station_url']
         else:
             host = stn_dict.get('host', '192.168.1.12')
             port = int(stn_dict.get('port', 80))
             self.station_url = "http://%s:%s/status.xml" % (host, port)
-        loginf("station url is %s" % self.station_url)
+        loginf("station url is %s", self.station_url)
         self.poll_interval = int(stn_dict.get('poll_interval', 2))
-        loginf("poll interval is %s" % self.poll_interval)
+        loginf("poll interval is %s", self.poll_interval)
         self.sensor_map = dict(IP100Driver.DEFAULT_MAP)
         if 'sensor_map' in stn_dict:
             self.sensor_map.update(stn_dict['sensor_map'])
-        loginf("sensor map: %s" % self.sensor_map)
+        loginf("sensor map: %s", self.sensor_map)
+        self._map_items = tuple(self.sensor_map.items())
+        self._packet_template = dict.fromkeys(self.sensor_map)
+        self._packet_template['dateTime'] = None
+        self._packet_template['usUnits'] = None
         self.max_tries = int(stn_dict.get('max_tries', 3))
         self.retry_wait = int(stn_dict.get('retry_wait', 5))
+        self.socket_timeout = float(stn_dict.get('socket_timeout', 4))
+        self._timer = _PollTimer(self.poll_interval)
+        self._http = IP100Station.make_session()
+        # packets, or the errors that happened instead, from the poll thread.
+        # the pipes let each thread block in select until the other one has
+        # something for it, so neither has to wake up periodically to check.
+        self._items = collections.deque(maxlen=2)
+        self._wake_r, self._wake_w = _make_pipe()
+        self._stop = threading.Event()
+        self._stop_r, self._stop_w = _make_pipe()
+        self._thread = None
+
+    def closePort(self):
+        if not self._stop_thread():
+            return
+        self._timer.close()
+        if self._http is not None:
+            self._http.close()
+        for fd in (self._wake_r, self._wake_w, self._stop_r, self._stop_w):
+            os.close(fd)
 
     @property
     def hardware_name(self):
         return "IP-100"
 
     def genLoopPackets(self):
+        # a thread that did not stop in time is told to carry on
+        self._stop.clear()
+        _drain(self._stop_r)
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._poll, name='ip100')
+            self._thread.daemon = True
+            self._thread.start()
         ntries = 0
-        while ntries < self.max_tries:
-            ntries += 1
+        while True:
             try:
-                data = IP100Station.get_data(self.station_url)
-                logdbg("data: %s" % data)
-                pkt = IP100Station.parse_data(data)
-                logdbg("raw packet: %s" % pkt)
+                item = self._items.popleft()
+            except IndexError:
+                _wait_readable(self._wake_r)
+                _drain(self._wake_r)
+                continue
+            if item is None:
+                self._stop_thread()
+                raise weewx.WeeWxIOError("poll thread died")
+            elif isinstance(item, weewx.WeeWxIOError):
+                ntries += 1
+                loginf("failed attempt %s of %s: %s",
+                       ntries, self.max_tries, item)
+                if ntries >= self.max_tries:
+                    self._stop_thread()
+                    raise weewx.WeeWxIOError(
+                        "max tries %s exceeded" % self.max_tries)
+            elif isinstance(item, tuple):
+                # the exc_info of a failure in the poll thread
+                self._stop_thread()
+                raise item[0], item[1], item[2]
+            else:
                 ntries = 0
-                packet = {'dateTime': int(time.time() + 0.5)}
-                if pkt['base_units'] == 'English':
-                    packet['usUnits'] = weewx.US
-                else:
-                    packet['usUnits'] = weewx.METRICWX
-                for k in self.sensor_map:
-                    if self.sensor_map[k] in pkt:
-                        packet[k] = pkt[self.sensor_map[k]]
-                yield packet
-                if self.poll_interval:
-                    time.sleep(self.poll_interval)
-            except weewx.WeeWxIOError, e:
-                loginf("failed attempt %s of %s: %s" %
-                       (ntries, self.max_tries, e))
-                time.sleep(self.retry_wait)
-        else:
-            raise weewx.WeeWxIOError("max tries %s exceeded" % self.max_tries)
+                yield item
+
+    def _stop_thread(self):
+        """Stop the poll thread and discard anything it left behind.
+        Return False if the thread is still running."""
+        self._stop.set()
+        _notify(self._stop_w)
+        if self._thread is not None:
+            self._thread.join(self.poll_interval + 2 * self.socket_timeout + 1)
+            if self._thread.is_alive():
+                logerr("poll thread did not stop")
+                return False
+            self._thread = None
+        self._items.clear()
+        _drain(self._wake_r)
+        return True
+
+    def _poll(self):
+        """Fetch and parse the station status on each poll interval, then
+        hand the packets to genLoopPackets.  The poll thread signals that it
+        has exited by handing over None."""
+        us, metricwx = weewx.US, weewx.METRICWX
+        _debug_enabled, _logmsg, _time = debug_enabled, logmsg, time.time
+        map_items = self._map_items
+        template = self._packet_template
+        nfail = 0
+        try:
+            while not self._stop.is_set():
+                # check the log level once per poll rather than per message
+                debug = _debug_enabled()
+                try:
+                    data = IP100Station.get_data(
+                        self.station_url, self._http, self.socket_timeout)
+                    if debug:
+                        _logmsg(syslog.LOG_DEBUG, "data: %s", data)
+                    pkt = IP100Station.parse_data(data)
+                    if debug:
+                        _logmsg(syslog.LOG_DEBUG, "raw packet: %s", pkt)
+                    # parse_data returns an empty dict for a document that
+                    # does not parse, including a truncated one, or that has
+                    # no status
+                    if not pkt or 'base_units' not in pkt:
+                        raise weewx.WeeWxIOError("empty or malformed status")
+                    packet = template.copy()
+                    packet['dateTime'] = int(_time() + 0.5)
+                    if pkt['base_units'] == 'English':
+                        packet['usUnits'] = us
+                    else:
+                        packet['usUnits'] = metricwx
+                    for dst, src in map_items:
+                        packet[dst] = pkt.get(src)
+                    nfail = 0
+                    self._put(packet)
+                    if self.poll_interval:
+                        self._timer.wait()
+                except weewx.WeeWxIOError, e:
+                    nfail += 1
+                    self._put(e)
+                    # back off, but return at once if told to stop
+                    _wait_readable(self._stop_r,
+                                   min(self.retry_wait * 2 ** (nfail - 1), 30))
+                except Exception, e:
+                    logerr("poll thread failed: %s", e)
+                    self._put(sys.exc_info())
+                    return
+        finally:
+            self._put(None)
+
+    def _put(self, item):
+        # never blocks; if genLoopPackets falls behind, the oldest item is
+        # dropped so that it gets the most recent readings
+        self._items.append(item)
+        _notify(self._wake_w)
+
+
+def _make_pipe():
+    r, w = os.pipe()
+    for fd in (r, w):
+        fcntl.fcntl(fd, fcntl.F_SETFL,
+                    fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    return r, w
+
+def _notify(fd):
+    try:
+        os.write(fd, 'x')
+    except OSError, e:
+        # a full pipe already has a wakeup pending
+        if e.errno != errno.EAGAIN:
+            raise
+
+def _drain(fd):
+    try:
+        while os.read(fd, 512):
+            pass
+    except OSError, e:
+        if e.errno != errno.EAGAIN:
+            raise
+
+def _wait_readable(fd, timeout=None):
+    # select blocks in the kernel but is still interrupted by signals
+    while True:
+        try:
+            return bool(select.select([fd], [], [], timeout)[0])
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+class _itimerspec(ctypes.Structure):
+    _fields_ = [('it_interval', _timespec), ('it_value', _timespec)]
+
+
+class _PollTimer(object):
+    """Block until the next multiple of the poll interval.
+
+    On linux this uses a timerfd armed with an absolute CLOCK_MONOTONIC
+    deadline, so wakeups are accurate and do not drift.  Anywhere else it
+    falls back to time.sleep."""
+
+    CLOCK_MONOTONIC = 1
+    TFD_CLOEXEC = 0o2000000
+    TFD_TIMER_ABSTIME = 1
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._fd = None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            self._clock_gettime = libc.clock_gettime
+            self._timerfd_settime = libc.timerfd_settime
+            fd = libc.timerfd_create(self.CLOCK_MONOTONIC, self.TFD_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "timerfd_create failed")
+            self._fd = fd
+        except (AttributeError, OSError), e:
+            logdbg("no timerfd, using sleep: %s", e)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def wait(self):
+        if self._fd is None:
+            now = time.time()
+            deadline = (math.floor(now / self.interval) + 1) * self.interval
+            time.sleep(deadline - now)
+            return
+        ts = _timespec()
+        self._clock_gettime(self.CLOCK_MONOTONIC, ctypes.byref(ts))
+        now = ts.tv_sec + ts.tv_nsec * 1e-9
+        deadline = (math.floor(now / self.interval) + 1) * self.interval
+        spec = _itimerspec()
+        spec.it_value.tv_sec = int(deadline)
+        spec.it_value.tv_nsec = int((deadline - int(deadline)) * 1e9)
+        if self._timerfd_settime(self._fd, self.TFD_TIMER_ABSTIME,
+                                 ctypes.byref(spec), None) < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, "timerfd_settime: %s" % os.strerror(e))
+        while True:
+            try:
+                os.read(self._fd, 8)
+                return
+            except OSError, e:
+                if e.errno != errno.EINTR:
+                    raise
 
 
 class IP100Station(object):
     @staticmethod
-    def get_data(url):
+    def make_session():
+        """Return a session that keeps the connection to the station open
+        between polls, or None if the requests module is not available."""
+        if requests is None:
+            logdbg("requests not available, using urllib2")
+            return None
+        session = requests.Session()
+        session.headers.update({'Connection': 'keep-alive'})
+        session.mount('http://', HTTPAdapter(pool_connections=1,
+                                             pool_maxsize=2))
+        return session
+
+    @staticmethod
+    def get_data(url, session=None, timeout=4):
+        if session is not None:
+            try:
+                response = session.get(url, timeout=timeout)
+                response.raise_for_status()
+                return response.content
+            except requests.exceptions.RequestException, e:
+                raise weewx.WeeWxIOError("get data failed: %s" % e)
         try:
-            response = urllib2.urlopen(url)
+            response = urllib2.urlopen(url, timeout=timeout)
             return response.read()
-        except (socket.error, socket.timeout, urllib2.HTTPError), e:
+        except (socket.error, socket.timeout, urllib2.URLError), e:
             raise weewx.WeeWxIOError("get data failed: %s" % e)
 
     @staticmethod
     def parse_data(data):
-        pkt = dict()
+        pkt = IP100Station.parse_data_fast(data)
+        if pkt is None:
+            pkt = IP100Station.parse_data_tree(data)
+        return pkt
+
+    @staticmethod
+    def parse_data_fast(data):
+        """Extract values from the status with regular expressions.
+
+        This only handles the layout of the status that the IP-100 emits: a
+        status root whose hardware and weather sections contain only plain
+        start and end tags, without attributes, self-closing tags or
+        entities.  Return None for anything else, or if anything expected
+        is missing, so that the caller can fall back to a full parse."""
+        root = _RX_ROOT.search(data)
+        if root is None or root.group(1) != 'status':
+            return None
+        hw = _RX_HARDWARE.search(data)
+        w = _RX_WEATHER.search(data)
+        if hw is None or w is None:
+            return None
+        hardware = hw.group(1)
+        weather = w.group(1)
+        if _RX_UNHANDLED.search(hardware) or _RX_UNHANDLED.search(weather):
+            return None
+        pkt = {t: v or None for t, v in _RX_LEAF.findall(hardware)}
+        if 'base_units' not in pkt:
+            return None
+        wind = _RX_WIND.search(weather)
+        if wind is None:
+            return None
+        kids = dict(_RX_LEAF.findall(wind.group(1)))
         try:
-            root = ElementTree.fromstring(data)
-            if root.tag == 'status':
-                pkt.update(IP100Station.parse_hardware(root.find('hardware')))
-                pkt.update(IP100Station.parse_weather(root.find('weather')))
-            else:
-                logerr("no status element in data")
-        except ElementTree.ParseError, e:
-            logdbg("parse failed: %s" % e)
+            pkt['wind_speed'] = float(kids['speed'])
+            pkt['wind_dir'] = float(kids['direction'])
+            pkt['gust_speed'] = float(kids['gust_speed'])
+            pkt['gust_dir'] = float(kids['gust_direction'])
+            for t, v in _RX_CURRENT.findall(weather):
+                pkt[t] = float(v)
+        except (KeyError, ValueError):
+            return None
         return pkt
 
     @staticmethod
-    def parse_hardware(hw):
+    def parse_data_tree(data):
         pkt = dict()
-        if not hw:
-            return pkt
-        for c in hw:
-            if len(c) == 0:
-                pkt[c.tag] = c.text
-            else:
-                pkt.update(IP100Station.parse_hardware(c))
+        try:
+            # stream the document, handing off each section of the status
+            # once it is complete then discarding it.
+            depth = 0
+            for event, elem in ElementTree.iterparse(
+                    io.BytesIO(data), events=('start', 'end')):
+                if event == 'start':
+                    if depth == 0 and elem.tag != 'status':
+                        logerr("no status element in data")
+                        break
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth == 1:
+                    if elem.tag == 'hardware':
+                        pkt.update(IP100Station.parse_hardware(elem))
+                    elif elem.tag == 'weather':
+                        pkt.update(IP100Station.parse_weather(elem))
+                    elem.clear()
+        except PARSE_ERRORS, e:
+            # sections handed off before the error are not to be trusted
+            # without the rest of the document
+            logdbg("parse failed: %s", e)
+            return dict()
         return pkt
 
+    @staticmethod
+    def parse_hardware(hw):
+        # flatten the hardware section, keeping only the leaf elements
+        if hw is None:
+            return dict()
+        return {e.tag: e.text for e in hw.iter()
+                if len(e) == 0 and e is not hw}
+
     @staticmethod
     def parse_weather(w):
         pkt = dict()
-        if not w:
+        if w is None:
             return pkt
         for c in w:
-            if c.tag == 'wind':
-                pkt['wind_speed'] = float(c.find('speed').text)
-                pkt['wind_dir'] = float(c.find('direction').text)
-                pkt['gust_speed'] = float(c.find('gust_speed').text)
-                pkt['gust_dir'] = float(c.find('gust_direction').text)
-            elif c.find('current') is not None:
-                pkt[c.tag] = float(c.find('current').text)
+            t = c.tag
+            if t == 'wind':
+                kids = {k.tag: k.text for k in c}
+                pkt['wind_speed'] = float(kids['speed'])
+                pkt['wind_dir'] = float(kids['direction'])
+                pkt['gust_speed'] = float(kids['gust_speed'])
+                pkt['gust_dir'] = float(kids['gust_direction'])
+            elif t in _CURRENT_TAGS:
+                # the station puts 'current' first, so try that before
+                # searching the element for it
+                if len(c) and c[0].tag == 'current':
+                    cur = c[0]
+                else:
+                    cur = c.find('current')
+                if cur is not None:
+                    pkt[t] = float(cur.text)
             else:
-                logdbg("ignored %s" % c.tag)
+                # not one of the known elements, but keep it if it has a
+                # current value in case the sensor map refers to it
+                cur = c.find('current')
+                if cur is not None:
+                    pkt[t] = float(cur.text)
+                else:
+                    logdbg("ignored %s", t)
         return pkt
 
 
@@ -238,6 +581,11 @@ if __name__ == '__main__':
                 data = f.read()
             packet = IP100Station.parse_data(data)
             print packet
+            # the regex fast path must agree with the full parse
+            tree_packet = IP100Station.parse_data_tree(data)
+            if packet != tree_packet:
+                print "full parse differs: ", tree_packet
+                exit(1)
             exit(0)
 
         url = "http://%s:%s" % (options.host, options.port)